@@ -1,18 +1,24 @@
 import os
 from flask import Flask
 from .routes import routes_bp
-from .models.database import Base, engine
+from .models.database import Base, engine, db_session
+from .models.imageModel import Image
 from .services.worker import start_worker
 from .utils.logging import logger
+from .utils.uploads import UploadRequest
 
 def create_app():
     # Create Flask app
     app = Flask(__name__)
+    app.request_class = UploadRequest
 
     # --- Configuration ---
     app.config["UPLOAD_DIR"] = os.path.join(os.path.dirname(__file__), "statics", "imageOG")
     app.config["THUMBNAIL_DIR"] = os.path.join(os.path.dirname(__file__), "statics", "thumbnails")
     app.config["MAX_CONTENT_LENGTH"] = 10 * 1024 * 1024  # 10 MB limit
+    # Hand thumbnail delivery to the front-end server: X-Sendfile (Apache) or X-Accel-Redirect (nginx)
+    app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE") == "1"
+    app.config["THUMBNAIL_ACCEL_PREFIX"] = os.getenv("THUMBNAIL_ACCEL_PREFIX")
 
     # Ensure directories exist
     os.makedirs(app.config["UPLOAD_DIR"], exist_ok=True)
@@ -20,8 +26,15 @@ def create_app():
 
     # --- Database setup ---
     Base.metadata.create_all(bind=engine)
+    # create_all skips tables that already exist, so add any indexes they are missing
+    for index in Image.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
     logger.info("Database tables initialized")
 
+    @app.teardown_appcontext
+    def remove_db_session(exception=None):
+        db_session.remove()
+
     # --- Register routes blueprint ---
     app.register_blueprint(routes_bp)
 
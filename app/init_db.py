@@ -2,10 +2,16 @@ import sys
 import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+from sqlalchemy import text
 from models.database import Base, engine
 from models.imageModel import Image
 
 if __name__ == "__main__":
     print("Creating database tables...")
     Base.metadata.create_all(bind=engine)
+    for index in Image.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+    # Superseded by ix_images_status_processed, whose leading column is status
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX IF EXISTS ix_images_status"))
     print("Database tables created successfully!")
\ No newline at end of file
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, JSON
+from sqlalchemy import Column, Integer, String, DateTime, JSON, Index
 from sqlalchemy.sql import func
 from .database import Base
 
@@ -13,4 +13,18 @@ class Image(Base):
     image_metadata = Column(JSON, nullable=True)
     thumbnails = Column(JSON, nullable=True)
     caption = Column(String, nullable=True)
-    status = Column(String, default="processing", index=True)
+    status = Column(String, default="processing")
+
+    __table_args__ = (
+        # Serves the /api/stats status filters and processed_at aggregates
+        Index("ix_images_status_processed", "status", "processed_at"),
+        Index("ix_images_created_at", "created_at"),
+    )
+
+class ImageCaptionCache(Base):
+    # Captions keyed by the SHA-256 of the image bytes, so re-uploads skip captioning
+    __tablename__ = "image_caption_cache"
+
+    sha256 = Column(String(64), primary_key=True)
+    caption = Column(String, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
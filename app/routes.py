@@ -1,159 +1,227 @@
+import mimetypes
 import os
-from datetime import datetime, timezone
+import secrets
+from functools import lru_cache
+from urllib.parse import quote
 from flask import Blueprint, current_app, request, jsonify, send_file, url_for
-from sqlalchemy import func as sa_func
+from sqlalchemy import case, insert, update, func as sa_func
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
 from .utils.logging import logger
-from .models.database import SessionLocal
+from .models.database import db_session
 from .models.imageModel import Image
 from .services.worker import enqueue_image_job
+from .utils.uploads import save_upload, stream_to_file
 
 routes_bp = Blueprint("routes_bp", __name__)
 
+# Not in every Python's mimetypes table (THUMBNAIL_WEBP thumbnails)
+mimetypes.add_type("image/webp", ".webp")
+
 ALLOWED_EXT = {"jpg", "jpeg", "png"}
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+THUMBNAIL_MAX_AGE = 365 * 24 * 60 * 60
 
 def error_response(msg, code=400):
     return jsonify({"status": "error", "data": None, "error": msg}), code
 
+@lru_cache(maxsize=16)
+def _thumbnail_url_templates(url_root):
+    # url_for runs once per URL root; each size is split around the image id placeholder
+    templates = {}
+    for size in ("small", "medium"):
+        url = url_for("routes_bp.get_thumbnail", image_id=0, size=size, _external=True)
+        head, tail = url.rsplit("/0/", 1)
+        templates[size] = (f"{head}/", f"/{tail}")
+    return templates
+
 def build_thumbnail_urls(image_id):
     return {
-        "small": url_for("routes_bp.get_thumbnail", image_id=image_id, size="small", _external=True),
-        "medium": url_for("routes_bp.get_thumbnail", image_id=image_id, size="medium", _external=True)
+        size: f"{head}{image_id}{tail}"
+        for size, (head, tail) in _thumbnail_url_templates(request.url_root).items()
     }
 
 @routes_bp.route("/api/images", methods=["POST"])
 def upload_image():
-    if "file" not in request.files:
-        return error_response("No file part")
-    file = request.files["file"]
-    if file.filename == "":
+    # Raw body uploads (Content-Type: application/octet-stream, ?filename=...) skip the multipart parser entirely
+    raw_upload = request.mimetype == "application/octet-stream"
+    if raw_upload:
+        if request.content_length == 0:
+            return error_response("Empty request body")
+        file = None
+        filename = request.args.get("filename", "")
+    else:
+        if "file" not in request.files:
+            return error_response("No file part")
+        file = request.files["file"]
+        filename = file.filename
+    if filename == "":
         return error_response("No file selected")
-    if file.filename.rsplit(".", 1)[-1].lower() not in ALLOWED_EXT:
+    if filename.rsplit(".", 1)[-1].lower() not in ALLOWED_EXT:
         return error_response("Unsupported file type")
 
-    db = SessionLocal()
+    image_id = None
     try:
         upload_dir = current_app.config["UPLOAD_DIR"]
-        os.makedirs(upload_dir, exist_ok=True)
-        timestamp = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
-        stored_filename = f"{timestamp}_{secure_filename(file.filename)}"
+        # Random prefix keeps names unique under concurrent uploads (strftime collided at µs granularity)
+        stored_filename = f"{secrets.token_hex(8)}_{secure_filename(filename)}"
         stored_path = os.path.join(upload_dir, stored_filename)
-        file.save(stored_path)
+        if raw_upload:
+            # Chunked bodies have no Content-Length, so an empty one is only known after reading it
+            if stream_to_file(request.stream, stored_path) == 0:
+                os.unlink(stored_path)
+                return error_response("Empty request body")
+        else:
+            save_upload(file, stored_path)
 
-        img = Image(original_name=file.filename, stored_path=stored_path)
-        db.add(img)
-        db.commit()
-        db.refresh(img)
+        # Core insert: the new id comes back from the INSERT itself (lastrowid), no refresh SELECT
+        result = db_session.execute(insert(Image).values(original_name=filename, stored_path=stored_path))
+        image_id = result.inserted_primary_key[0]
+        db_session.commit()
 
-        enqueue_image_job(img.id, stored_path, file.filename)
+        enqueue_image_job(image_id, stored_path, filename)
 
         return jsonify({
             "status": "success",
             "data": {
-                "image_id": img.id,
-                "original_name": file.filename,
+                "image_id": image_id,
+                "original_name": filename,
                 "status": "processing"
             },
             "error": None
         }), 202
+    except HTTPException:
+        # e.g. RequestEntityTooLarge while reading a raw body past MAX_CONTENT_LENGTH -> 413
+        db_session.rollback()
+        raise
     except Exception as e:
-        db.rollback()
+        db_session.rollback()
         logger.exception(e)
+        if image_id is not None:
+            # The row is committed but no job will ever process it
+            _mark_upload_failed(image_id)
         return error_response(str(e), 500)
-    finally:
-        db.close()
+
+def _mark_upload_failed(image_id):
+    try:
+        db_session.execute(update(Image).where(Image.id == image_id).values(status="failed"))
+        db_session.commit()
+    except Exception as e:
+        db_session.rollback()
+        logger.exception("Could not mark upload {} failed: {}", image_id, e)
 
 @routes_bp.route("/api/images", methods=["GET"])
 def list_images():
-    db = SessionLocal()
+    # Keyset pagination, newest first: ?limit=N&cursor=<image_id of the last row on the previous page>
     try:
-        imgs = db.query(Image).all()
-        data = []
-        for i in imgs:
-            thumbnails = build_thumbnail_urls(i.id) if i.thumbnails and isinstance(i.thumbnails, dict) else {}
-            data.append({
-                "image_id": i.id,
-                "original_name": i.original_name,
-                "processed_at": i.processed_at.isoformat() if i.processed_at else None,
-                "status": i.status,
-                "thumbnails": thumbnails
-            })
-        return jsonify({"status": "success", "data": data, "error": None})
-    finally:
-        db.close()
+        limit = min(int(request.args.get("limit", DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+    except ValueError:
+        return error_response("Invalid limit")
+    if limit < 1:
+        return error_response("Invalid limit")
+    cursor = request.args.get("cursor")
+    if cursor is not None:
+        try:
+            cursor = int(cursor)
+        except ValueError:
+            return error_response("Invalid cursor")
+        if cursor < 1:
+            return error_response("Invalid cursor")
+
+    query = db_session.query(
+        Image.id,
+        Image.original_name,
+        Image.processed_at,
+        Image.status,
+        Image.thumbnails.isnot(None).label("has_thumbnails")
+    )
+    if cursor is not None:
+        query = query.filter(Image.id < cursor)
+    rows = query.order_by(Image.id.desc()).limit(limit).all()
+
+    data = []
+    for i in rows:
+        thumbnails = build_thumbnail_urls(i.id) if i.has_thumbnails else {}
+        data.append({
+            "image_id": i.id,
+            "original_name": i.original_name,
+            "processed_at": i.processed_at.isoformat() if i.processed_at else None,
+            "status": i.status,
+            "thumbnails": thumbnails
+        })
+    next_cursor = rows[-1].id if len(rows) == limit else None
+    return jsonify({"status": "success", "data": data, "next_cursor": next_cursor, "error": None})
 
 @routes_bp.route("/api/images/<int:image_id>/thumbnails/<size>", methods=["GET"])
 def get_thumbnail(image_id, size):
     if size not in {"small", "medium"}:
         return error_response("Invalid size")
-    db = SessionLocal()
-    try:
-        img = db.query(Image).filter(Image.id == image_id).first()
-        if not img or not img.thumbnails or size not in img.thumbnails:
-            return error_response("Thumbnail not found", 404)
-        path = img.thumbnails[size]
-        if not os.path.exists(path):
-            return error_response("File missing", 404)
-        return send_file(path)
-    finally:
-        db.close()
+    img = db_session.query(Image).filter(Image.id == image_id).first()
+    if not img or not img.thumbnails or size not in img.thumbnails:
+        return error_response("Thumbnail not found", 404)
+    path = img.thumbnails[size]
+    if not os.path.exists(path):
+        return error_response("File missing", 404)
+    accel_prefix = current_app.config["THUMBNAIL_ACCEL_PREFIX"]
+    if accel_prefix:
+        # nginx serves the file itself via sendfile(2); Python only returns the header
+        response = current_app.response_class(mimetype=mimetypes.guess_type(path)[0])
+        response.headers["X-Accel-Redirect"] = f"{accel_prefix.rstrip('/')}/{quote(os.path.basename(path))}"
+        response.cache_control.public = True
+        response.cache_control.max_age = THUMBNAIL_MAX_AGE
+        return response
+    # Thumbnail files are never rewritten (unique name per upload), so clients can cache them for a year
+    return send_file(path, conditional=True, etag=True, max_age=THUMBNAIL_MAX_AGE)
 
 @routes_bp.route("/api/images/<int:image_id>", methods=["GET"])
 def get_image_details(image_id):
-    db = SessionLocal()
-    try:
-        img = db.query(Image).filter(Image.id == image_id).first()
-        if not img:
-            return error_response("Image not found", 404)
-        thumbnails = build_thumbnail_urls(img.id) if img.thumbnails else {}
-        return jsonify({
-            "status": "success",
-            "data": {
-                "image_id": img.id,
-                "original_name": img.original_name,
-                "status": img.status,
-                "created_at": img.created_at.isoformat() if img.created_at else None,
-                "processed_at": img.processed_at.isoformat() if img.processed_at else None,
-                "metadata": img.image_metadata,
-                "thumbnails": thumbnails,
-                "caption": img.caption
-            },
-            "error": None
-        })
-    finally:
-        db.close()
+    img = db_session.query(Image).filter(Image.id == image_id).first()
+    if not img:
+        return error_response("Image not found", 404)
+    thumbnails = build_thumbnail_urls(img.id) if img.thumbnails else {}
+    return jsonify({
+        "status": "success",
+        "data": {
+            "image_id": img.id,
+            "original_name": img.original_name,
+            "status": img.status,
+            "created_at": img.created_at.isoformat() if img.created_at else None,
+            "processed_at": img.processed_at.isoformat() if img.processed_at else None,
+            "metadata": img.image_metadata,
+            "thumbnails": thumbnails,
+            "caption": img.caption
+        },
+        "error": None
+    })
 
 @routes_bp.route("/api/stats", methods=["GET"])
 def get_stats():
-    db = SessionLocal()
-    try:
-        total_images = db.query(sa_func.count(Image.id)).scalar()
-        successful = db.query(Image).filter(Image.status == "success").count()
-        failed = db.query(Image).filter(Image.status == "failed").count()
-        processing = total_images - successful - failed
-        success_rate = (successful / total_images * 100) if total_images else 0
-
-        diffs = [
-            (i.processed_at - i.created_at).total_seconds()
-            for i in db.query(Image).filter(Image.processed_at.isnot(None)).all()
-            if i.created_at and i.processed_at
-        ]
-        avg_time = round(sum(diffs) / len(diffs), 2) if diffs else 0
+    # Totals and average latency in a single aggregate query (SQLite: julianday diff in days -> seconds)
+    total_images, successful, failed, avg_seconds = db_session.query(
+        sa_func.count(Image.id),
+        sa_func.sum(case((Image.status == "success", 1), else_=0)),
+        sa_func.sum(case((Image.status == "failed", 1), else_=0)),
+        sa_func.avg((sa_func.julianday(Image.processed_at) - sa_func.julianday(Image.created_at)) * 86400),
+    ).one()
+    successful = successful or 0
+    failed = failed or 0
+    processing = total_images - successful - failed
+    success_rate = (successful / total_images * 100) if total_images else 0
+    avg_time = round(avg_seconds, 2) if avg_seconds is not None else 0
 
-        return jsonify({
-            "status": "success",
-            "data": {
-                "total_images": total_images,
-                "successful": successful,
-                "failed": failed,
-                "processing": processing,
-                "success_rate": round(success_rate, 2),
-                "average_processing_time_seconds": avg_time
-            },
-            "error": None
-        })
-    finally:
-        db.close()
+    return jsonify({
+        "status": "success",
+        "data": {
+            "total_images": total_images,
+            "successful": successful,
+            "failed": failed,
+            "processing": processing,
+            "success_rate": round(success_rate, 2),
+            "average_processing_time_seconds": avg_time
+        },
+        "error": None
+    })
 
 @routes_bp.route("/", methods=["GET"])
 def health_check():
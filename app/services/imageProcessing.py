@@ -1,137 +1,637 @@
+import functools
+import hashlib
+import mimetypes
 import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from datetime import datetime, timezone
-from PIL import Image as PILImage, UnidentifiedImageError
-import exifread
+from fractions import Fraction
+from PIL import Image as PILImage, UnidentifiedImageError, features
+from PIL.ExifTags import GPSTAGS, IFD, TAGS
+from PIL.TiffImagePlugin import IFDRational
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from urllib3.util.retry import Retry
+from ..models.database import SessionLocal
+from ..models.imageModel import ImageCaptionCache
 from ..utils.logging import logger
 from werkzeug.utils import secure_filename
-from transformers import BlipProcessor, BlipForConditionalGeneration
-import torch
+try:
+    import numpy as np
+    from turbojpeg import TurboJPEG, TJFLAG_PROGRESSIVE, TJPF_RGB, TJSAMP_420
+    _TURBOJPEG = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # PyTurboJPEG or the libturbojpeg shared library is missing: Pillow handles JPEG decode/encode
+    _TURBOJPEG = None
 
 THUMB_SIZES = {"small": (128, 128), "medium": (512, 512)}
+# Thumbnails are written once and served many times, so favour smaller files over encode speed.
+# PNG keeps an explicit zlib level: Pillow's optimize=True would force level 9.
+THUMB_SAVE_OPTIONS = {
+    "jpg": {"format": "JPEG", "quality": 85, "optimize": True, "progressive": True, "subsampling": 2},
+    "png": {"format": "PNG", "compress_level": 6},
+    "webp": {"format": "WEBP", "quality": 85, "method": 4},
+}
+# THUMBNAIL_WEBP=1 writes every thumbnail as WebP instead of the source's JPEG/PNG,
+# if this Pillow build has a WebP encoder (a source build without libwebp doesn't)
+THUMBNAIL_WEBP = os.getenv("THUMBNAIL_WEBP") == "1"
+if THUMBNAIL_WEBP and not features.check("webp"):
+    logger.warning("THUMBNAIL_WEBP is set but Pillow has no WebP support; writing JPEG/PNG thumbnails")
+    THUMBNAIL_WEBP = False
+HF_API_KEY = os.getenv("HF_API_KEY")
+# "vit" is raced against BLIP when BLIP is slow (e.g. cold-loading) or failing
+HF_ENDPOINTS = {
+    "blip": "https://api-inference.huggingface.co/models/Salesforce/blip-image-captioning-base",
+    "vit": "https://api-inference.huggingface.co/models/nlpconnect/vit-gpt2-image-captioning",
+}
+HF_HEDGE_DELAY = 2.0
+HF_HEALTH_URL = "https://huggingface.co/api/whoami-v2"
+HF_HEALTH_INTERVAL = 30
 
-# Load BLIP model and processor once (module level)
-try:
-    processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-    model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
+# Circuit breaker per endpoint: after BREAKER_THRESHOLD consecutive outage failures (5xx/429/timeouts)
+# the endpoint is skipped for min(300, 2**fail) seconds, or until the health probe passes 3 times in a row
+BREAKER_THRESHOLD = 3
+_BREAKERS = {name: {"fail": 0, "open_until": 0.0} for name in HF_ENDPOINTS}
+_BREAKER_LOCK = threading.Lock()
+_HEALTH_PROBE_STARTED = False
+
+# Shared session so the HTTPS connection to the HF endpoint is pooled across captions;
+# retries cover the endpoint's frequent 429/5xx responses (urllib3 rewinds the file body between attempts)
+HF_POOL_SIZE = 32
+HF_SESSION = requests.Session()
+HF_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=HF_POOL_SIZE,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504], allowed_methods=["POST"])
+))
+if HF_API_KEY:
+    HF_SESSION.headers.update({"Authorization": f"Bearer {HF_API_KEY}"})
+
+# BLIP resizes its input to 384x384, so captioning never needs a larger decode
+CAPTION_INPUT_SIZE = (384, 384)
+
+# In-flight HF API requests; sized to HF_SESSION's connection pool
+_HF_EXECUTOR = ThreadPoolExecutor(max_workers=HF_POOL_SIZE, thread_name_prefix="HFCaption")
+
+# Hashes the upload in prepare_image while EXIF and thumbnails run (hashlib and Pillow both release the GIL)
+_HASH_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="PrepareHash")
+
+BLIP_MODEL_NAME = "Salesforce/blip-image-captioning-base"
+
+# Serialises loading and use of the shared BLIP model across worker threads
+_MODEL_LOCK = threading.Lock()
+
+# Images per model.generate call; keep CPU batches small so one batch doesn't stall the worker
+CAPTION_BATCH_SIZES = {"cuda": 8, "cpu": 2}
+# Decode steps per caption; captions rarely need more
+CAPTION_MAX_TOKENS = 20
+
+
+@functools.lru_cache(maxsize=1)
+def _torch():
+    """
+    Import torch on first use and pick the device; returns (torch, device, model_dtype).
+    Only local BLIP needs it, so prepare worker processes and HF API deployments never import it.
+    """
+    import torch
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    model = model.to(device)
-    model.eval()
-    logger.info(f"BLIP model loaded on {device}")
-except Exception as e:
-    logger.exception(f"Failed to load BLIP model: {e}")
-    processor = None
-    model = None
-    device = "cpu"
+    return torch, device, torch.float16 if device == "cuda" else torch.float32
+
+
+def _autocast():
+    # FP16 autocast on GPU; a no-op on CPU where the model is int8-quantised instead
+    torch, device, _ = _torch()
+    return torch.autocast(device_type=device, dtype=torch.float16, enabled=device == "cuda")
+
+
+@functools.lru_cache(maxsize=1)
+def _blip():
+    """
+    Load BLIP once per process and warm it up; returns (processor, model), or None if loading failed.
+    Callers hold _MODEL_LOCK so concurrent first calls don't load it twice.
+    """
+    try:
+        from transformers import BlipProcessor, BlipForConditionalGeneration
+        torch, device, model_dtype = _torch()
+        processor = BlipProcessor.from_pretrained(BLIP_MODEL_NAME)
+        # No low_cpu_mem_usage: it requires accelerate, which isn't a dependency
+        model = BlipForConditionalGeneration.from_pretrained(BLIP_MODEL_NAME, torch_dtype=model_dtype)
+        if device == "cpu":
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        model = model.to(device).eval()
+        if device != "cuda" or not _compile_blip(processor, model):
+            _warm_up(processor, model)
+        logger.info("BLIP model loaded on {} ({})", device, "fp16" if device == "cuda" else "int8")
+        return processor, model
+    except Exception as e:
+        logger.exception("Failed to load BLIP model: {}", e)
+        return None
+
+
+def _warm_up(processor, model):
+    # Dummy generates at the real shapes (a single image, a full batch, full caption length) so the
+    # first real jobs don't pay for kernel setup, compilation or CUDA graph capture under _MODEL_LOCK
+    torch, device, model_dtype = _torch()
+    with torch.inference_mode(), _autocast():
+        for batch_size in sorted({1, CAPTION_BATCH_SIZES[device]}):
+            images = [PILImage.new("RGB", CAPTION_INPUT_SIZE)] * batch_size
+            dummy = processor(images, return_tensors="pt").to(device, model_dtype)
+            model.generate(**dummy, max_new_tokens=CAPTION_MAX_TOKENS, do_sample=False, num_beams=1)
+
+
+def _compile_blip(processor, model):
+    """
+    Compile the vision encoder and text decoder forwards (generate() calls those directly) and warm them up.
+    torch.compile only fails on first call, so a failed warm-up restores the eager forwards; returns False then.
+    """
+    torch, _, _ = _torch()
+    eager = model.vision_model.forward, model.text_decoder.forward
+    try:
+        # The encoder always sees 384x384 inputs, so CUDA graphs replay well there; dynamic=True keeps
+        # batch sizes (and the decoder's growing sequence/KV-cache lengths) from forcing a recompile each
+        model.vision_model.forward = torch.compile(eager[0], mode="reduce-overhead", dynamic=True)
+        model.text_decoder.forward = torch.compile(eager[1], dynamic=True)
+        _warm_up(processor, model)
+        return True
+    except Exception as e:
+        logger.warning("torch.compile failed, running BLIP eagerly: {}", e)
+        model.vision_model.forward, model.text_decoder.forward = eager
+        return False
+
+
+def load_caption_model():
+    with _MODEL_LOCK:
+        return _blip()
 
 
 def safe_open_image(path):
     try:
         return PILImage.open(path)
     except UnidentifiedImageError:
-        logger.error(f"Unidentified image: {path}")
+        logger.error("Unidentified image: {}", path)
         raise
     except Exception as e:
-        logger.exception(f"Error opening image: {e}")
+        logger.exception("Error opening image: {}", e)
         raise
 
 
-def generate_thumbnails(pil_img, original_name, timestamp, thumbnail_dir):
+def _turbo_scaling_factor(image_size, size):
+    # Smallest libjpeg-turbo scale (1/8 .. 1) whose output still covers `size`, same rule as PIL's draft()
+    needed = max(size[0] / image_size[0], size[1] / image_size[1])
+    factors = [f for f in _TURBOJPEG.scaling_factors if needed <= f[0] / f[1] <= 1]
+    return min(factors, key=lambda f: f[0] / f[1]) if factors else (1, 1)
+
+
+def _decode_downscaled(pil_img, size):
+    """
+    Decode a lazily opened image at the smallest scale that still covers `size`.
+    JPEGs go through libjpeg-turbo's scaled IDCT when PyTurboJPEG is available, else Pillow's draft().
+    """
+    if pil_img.format != "JPEG":
+        return pil_img
+    if _TURBOJPEG is not None and pil_img.filename:
+        try:
+            with open(pil_img.filename, "rb") as f:
+                pixels = _TURBOJPEG.decode(
+                    f.read(), pixel_format=TJPF_RGB, scaling_factor=_turbo_scaling_factor(pil_img.size, size)
+                )
+            return PILImage.fromarray(pixels)
+        except Exception as e:
+            # e.g. CMYK JPEGs, which TurboJPEG can't decode to RGB
+            logger.debug("TurboJPEG decode failed, using Pillow: {}", e)
+    # libjpeg scales down in the DCT domain while decoding (1/2, 1/4, 1/8), never below `size`
+    pil_img.draft("RGB", size)
+    return pil_img
+
+
+def _open_rgb_for_size(path, size):
+    return _decode_downscaled(PILImage.open(path), size).convert("RGB")
+
+
+def _save_thumbnail(img, path, ext):
+    options = THUMB_SAVE_OPTIONS[ext]
+    if ext == "jpg" and _TURBOJPEG is not None and img.mode == "RGB":
+        data = _TURBOJPEG.encode(
+            np.asarray(img), quality=options["quality"], pixel_format=TJPF_RGB, jpeg_subsample=TJSAMP_420,
+            flags=TJFLAG_PROGRESSIVE
+        )
+        with open(path, "wb") as f:
+            f.write(data)
+    else:
+        img.save(path, **options)
+
+
+def _fit(size, dims):
+    # Same bounding-box rule as PIL's Image.thumbnail: keep aspect ratio, never upscale
+    width, height = size
+    scale = min(dims[0] / width, dims[1] / height, 1)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def generate_thumbnails(pil_img, original_name, prefix, thumbnail_dir):
     thumbnails = {}
-    for size, dims in THUMB_SIZES.items():
-        img_copy = pil_img.copy()
-        img_copy.thumbnail(dims)
-        ext = "jpg" if pil_img.format and pil_img.format.lower() in ("jpeg", "jpg") else "png"
-        filename = f"{timestamp}_{size}_{secure_filename(original_name)}"
-        if not filename.lower().endswith(f".{ext}"):
-            filename += f".{ext}"
-        path = os.path.join(thumbnail_dir, filename)
-        if img_copy.mode in ("RGBA", "P"):
-            img_copy = img_copy.convert("RGB")
-        img_copy.save(path)
+    # Decode once, at a reduced scale that still covers the largest thumbnail
+    current = _decode_downscaled(pil_img, max(THUMB_SIZES.values()))
+    if current.mode in ("RGBA", "P"):
+        current = current.convert("RGB")
+    if THUMBNAIL_WEBP:
+        ext = "webp"
+    else:
+        ext = "jpg" if pil_img.format == "JPEG" else "png"
+    safe_name = secure_filename(original_name)
+    suffix = "" if safe_name.lower().endswith(f".{ext}") else f".{ext}"
+    # Largest size first; each smaller thumbnail is resampled from the previous one, not the original.
+    # reducing_gap box-reduces by an integer factor first, so LANCZOS only runs over the last <=3x step
+    for size, dims in sorted(THUMB_SIZES.items(), key=lambda item: item[1], reverse=True):
+        current = current.resize(_fit(current.size, dims), PILImage.Resampling.LANCZOS, reducing_gap=3.0)
+        path = os.path.join(thumbnail_dir, f"{prefix}_{size}_{safe_name}{suffix}")
+        _save_thumbnail(current, path, ext)
         thumbnails[size] = path
-        logger.info(f"Generated thumbnail {size}: {path}")
+        logger.debug("Generated thumbnail {}: {}", size, path)
     return thumbnails
 
 
-def extract_exif(path):
+def _exifread_tags(path):
+    # Fallback only: imported on first use so Pillow-parsable images never load exifread
+    import exifread
+    with open(path, "rb") as f:
+        tags = exifread.process_file(f, details=False)
+    # Same groups as the Pillow path: no thumbnail/interop IFDs and no sub-IFD offset pointers
+    tags = {
+        str(k): str(v) for k, v in tags.items()
+        if str(k).split(" ", 1)[0] in EXIF_GROUPS and str(k) not in ("Image ExifOffset", "Image GPSInfo")
+    }
+    return tags or None
+
+
+# MakerNote is an opaque vendor blob that can run to tens of KB
+EXIF_MAKER_NOTE = 0x927C
+
+
+# Key prefixes used by exifread ("Image Make", "EXIF DateTimeOriginal", "GPS GPSLatitude"), kept for both paths
+EXIF_GROUPS = ("Image", "EXIF", "GPS")
+
+
+def _exif_value(value):
+    # exifread's formatting: rationals as reduced fractions ("1/100"), multi-value tags as "[a, b, c]"
+    if isinstance(value, tuple):
+        return "[" + ", ".join(_exif_value(v) for v in value) + "]"
+    if isinstance(value, IFDRational):
+        if value.denominator == 0:
+            return f"{value.numerator}/0"
+        return str(Fraction(value.numerator, value.denominator))
+    return str(value)
+
+
+def _exif_strings(ifd, names, group, skip=()):
+    # Raw bytes values (MakerNote, UserComment, ...) are dropped like exifread's details=False did,
+    # rather than stored as b'\x..' reprs
+    return {
+        f"{group} {names.get(k, f'Tag 0x{k:04X}')}": _exif_value(v) for k, v in ifd.items()
+        if k != EXIF_MAKER_NOTE and k not in skip and not isinstance(v, bytes)
+    }
+
+
+def extract_exif(pil_img, path=None):
+    """
+    Read EXIF from the already-open PIL image (IFD0 plus the Exif and GPS sub-IFDs), so the file
+    isn't opened a second time. exifread on `path` is only used if Pillow can't parse the block.
+    """
     try:
-        with open(path, "rb") as f:
-            tags = exifread.process_file(f, details=False)
-        return {str(k): str(v) for k, v in tags.items()} if tags else None
+        exif = pil_img.getexif()
+        tags = _exif_strings(exif, TAGS, "Image", skip=(IFD.Exif, IFD.GPSInfo))
+        tags.update(_exif_strings(exif.get_ifd(IFD.Exif), TAGS, "EXIF"))
+        tags.update(_exif_strings(exif.get_ifd(IFD.GPSInfo), GPSTAGS, "GPS"))
+        return tags or None
+    except Exception as e:
+        if path is None:
+            logger.warning("EXIF extraction failed: {}", e)
+            return None
+    try:
+        return _exifread_tags(path)
     except Exception as e:
-        logger.warning(f"EXIF extraction failed: {e}")
+        logger.warning("EXIF extraction failed: {}", e)
         return None
 
 
-def generate_local_caption_from_path(path, max_tokens=30):
+def _clean_caption(caption):
+    # Clean up generic captions
+    if caption.lower().startswith("a picture of "):
+        caption = caption[13:]
+    elif caption.lower().startswith("an image of "):
+        caption = caption[12:]
+    return caption.strip()
+
+
+def _fallback_caption(path):
+    try:
+        with PILImage.open(path) as img:
+            return f"An image ({img.width}x{img.height}, {img.format or 'unknown format'})"
+    except Exception:
+        return "An uploaded image"
+
+
+def _blip_captions(paths, max_tokens=CAPTION_MAX_TOKENS):
+    # One entry per path; None where BLIP couldn't caption the image
+    blip = load_caption_model()
+    if blip is None:
+        logger.warning("BLIP model not loaded; skipping caption generation.")
+        return [None] * len(paths)
+    processor, model = blip
+    torch, device, model_dtype = _torch()
+    batch_size = CAPTION_BATCH_SIZES[device]
+
+    captions = []
+    for start in range(0, len(paths), batch_size):
+        batch = paths[start:start + batch_size]
+        try:
+            raw_images = [_open_rgb_for_size(p, CAPTION_INPUT_SIZE) for p in batch]
+
+            with _MODEL_LOCK, torch.inference_mode(), _autocast():
+                inputs = processor(raw_images, return_tensors="pt", padding=True).to(device, model_dtype)
+                out = model.generate(**inputs, max_new_tokens=max_tokens, do_sample=False, num_beams=1)
+                decoded = processor.batch_decode(out, skip_special_tokens=True)
+
+            captions.extend(_clean_caption(c) for c in decoded)
+
+        except Exception as e:
+            logger.exception("BLIP caption generation failed: {}", e)
+            captions.extend([None] * len(batch))
+    return captions
+
+
+def generate_local_captions_from_paths(paths, max_tokens=CAPTION_MAX_TOKENS):
+    """
+    Generate captions for several image files with one BLIP call per batch.
+    Returns one caption per path, in the same order.
+    """
+    captions = _blip_captions(paths, max_tokens)
+    return [c if c is not None else _fallback_caption(p) for p, c in zip(paths, captions)]
+
+
+def generate_local_caption_from_path(path, max_tokens=CAPTION_MAX_TOKENS):
     """
     Generate caption from an image file path.
     Follows Hugging Face BLIP examples (unconditional captioning).
     """
-    if not processor or not model:
-        logger.warning("BLIP model not loaded; skipping caption generation.")
-        return "An uploaded image"
+    return generate_local_captions_from_paths([path], max_tokens)[0]
 
-    try:
-        raw_image = PILImage.open(path).convert("RGB")
 
-        with torch.no_grad():
-            inputs = processor(raw_image, return_tensors="pt", padding=True).to(device)
-            out = model.generate(**inputs, max_new_tokens=max_tokens, do_sample=False, num_beams=1)
-            caption = processor.decode(out[0], skip_special_tokens=True)
+def _is_outage(exc):
+    if isinstance(exc, (requests.Timeout, requests.ConnectionError, requests.exceptions.RetryError)):
+        return True
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return False
 
-        # Clean up generic captions
-        if caption.lower().startswith("a picture of "):
-            caption = caption[13:]
-        elif caption.lower().startswith("an image of "):
-            caption = caption[12:]
 
-        return caption.strip()
+def _record_outcome(name, ok):
+    opened = False
+    with _BREAKER_LOCK:
+        state = _BREAKERS[name]
+        if ok:
+            state["fail"] = 0
+            state["open_until"] = 0.0
+        else:
+            state["fail"] += 1
+            if state["fail"] >= BREAKER_THRESHOLD:
+                state["open_until"] = time.monotonic() + min(300, 2 ** state["fail"])
+                opened = True
+    if opened:
+        logger.warning("HF endpoint {} circuit open after {} failures", name, state["fail"])
+        _start_health_probe()
 
-    except Exception as e:
-        logger.exception(f"BLIP caption generation failed: {e}")
+
+def _health_probe_loop():
+    # Close every open breaker once the HF API has answered HF_HEALTH_INTERVAL probes 3 times in a row
+    passes = 0
+    while True:
+        time.sleep(HF_HEALTH_INTERVAL)
+        with _BREAKER_LOCK:
+            any_open = any(state["fail"] >= BREAKER_THRESHOLD for state in _BREAKERS.values())
+        if not any_open:
+            passes = 0
+            continue
         try:
-            with PILImage.open(path) as img:
-                return f"An image ({img.width}x{img.height}, {img.format or 'unknown format'})"
+            HF_SESSION.get(HF_HEALTH_URL, timeout=10).raise_for_status()
+            passes += 1
         except Exception:
-            return "An uploaded image"
+            passes = 0
+        if passes >= 3:
+            with _BREAKER_LOCK:
+                for state in _BREAKERS.values():
+                    state["fail"] = 0
+                    state["open_until"] = 0.0
+            logger.info("HF health probe passed; circuit breakers closed")
+            passes = 0
+
+
+def _start_health_probe():
+    global _HEALTH_PROBE_STARTED
+    with _BREAKER_LOCK:
+        if _HEALTH_PROBE_STARTED:
+            return
+        _HEALTH_PROBE_STARTED = True
+    threading.Thread(target=_health_probe_loop, daemon=True, name="HFHealthProbe").start()
 
 
-def process_image_task(file_storage, upload_dir, thumbnail_dir):
+def _post_caption(name, path):
+    with _BREAKER_LOCK:
+        if time.monotonic() < _BREAKERS[name]["open_until"]:
+            raise RuntimeError(f"HF endpoint {name} circuit open; skipping")
+    # The file is streamed as the raw request body rather than multipart-encoded in memory
+    # Authorization comes from HF_SESSION's default headers
+    headers = {"Content-Type": mimetypes.guess_type(path)[0] or "application/octet-stream"}
+    try:
+        with open(path, "rb") as f:
+            response = HF_SESSION.post(HF_ENDPOINTS[name], headers=headers, data=f, timeout=30)
+        response.raise_for_status()
+    except Exception as e:
+        if _is_outage(e):
+            _record_outcome(name, ok=False)
+        raise
+    _record_outcome(name, ok=True)
+    result = response.json()
+    logger.debug("HF caption result from {}: {}", name, result)
+    return _clean_caption(result[0]["generated_text"])
+
+
+def _hf_captions(paths):
     """
-    file_storage: the file object received from Flask POST request (request.files['file'])
+    Caption several images concurrently with the HF Inference API, sharing HF_SESSION's pool.
+    Each image goes to BLIP first; if that hasn't succeeded within HF_HEDGE_DELAY, ViT-GPT2 is
+    asked as well and the first success wins. Returns None for images where both failed.
     """
-    os.makedirs(upload_dir, exist_ok=True)
-    os.makedirs(thumbnail_dir, exist_ok=True)
+    attempts = [[_HF_EXECUTOR.submit(_post_caption, "blip", p)] for p in paths]
+    wait([futures[0] for futures in attempts], timeout=HF_HEDGE_DELAY)
+    for path, futures in zip(paths, attempts):
+        if not futures[0].done() or futures[0].exception() is not None:
+            futures.append(_HF_EXECUTOR.submit(_post_caption, "vit", path))
 
-    timestamp = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
-    original_name = file_storage.filename
-    stored_filename = f"{timestamp}_{secure_filename(original_name)}"
-    stored_path = os.path.join(upload_dir, stored_filename)
-    file_storage.save(stored_path)
+    captions = []
+    for futures in attempts:
+        caption = None
+        for future in as_completed(futures):
+            try:
+                caption = future.result()
+                break
+            except Exception as e:
+                logger.warning("HF caption request failed: {}", e)
+        for future in futures:
+            future.cancel()
+        captions.append(caption)
+    return captions
 
+
+def get_caption_from_hf(path):
+    """
+    Caption an image with the Hugging Face Inference API, falling back to local BLIP on failure.
+    """
+    return generate_captions([path])[0]
+
+
+def file_sha256(path):
+    with open(path, "rb") as f:
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        # Python < 3.11
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+        return digest.hexdigest()
+
+
+def _cached_captions(digests):
+    try:
+        with SessionLocal() as db:
+            rows = db.execute(
+                select(ImageCaptionCache.sha256, ImageCaptionCache.caption)
+                .where(ImageCaptionCache.sha256.in_(set(digests)))
+            ).all()
+    except Exception as e:
+        logger.warning("Caption cache lookup failed: {}", e)
+        return {}
+    return dict(rows)
+
+
+def _store_captions(entries):
+    try:
+        with SessionLocal() as db:
+            db.execute(
+                sqlite_insert(ImageCaptionCache).on_conflict_do_nothing(index_elements=["sha256"]),
+                [{"sha256": digest, "caption": caption} for digest, caption in entries.items()]
+            )
+            db.commit()
+    except Exception as e:
+        logger.warning("Caption cache write failed: {}", e)
+
+
+def _model_captions(paths):
+    # HF API first when configured, then local BLIP for whatever is still missing; None where both failed
+    if not HF_API_KEY:
+        return _blip_captions(paths)
+
+    captions = _hf_captions(paths)
+    missing = [i for i, caption in enumerate(captions) if caption is None]
+    if missing:
+        logger.warning("HF caption API failed for {} image(s), using local BLIP", len(missing))
+        local = _blip_captions([paths[i] for i in missing])
+        for i, caption in zip(missing, local):
+            captions[i] = caption
+    return captions
+
+
+def generate_captions(paths, digests=None):
+    """
+    One caption per path: via the HF Inference API when HF_API_KEY is set, otherwise local BLIP in batches.
+    Images the API couldn't caption are captioned locally, also in one batch.
+    Captions are cached by content hash (digests, computed here if not given), so duplicate uploads skip both.
+    """
+    if digests is None:
+        digests = [file_sha256(p) for p in paths]
+    cached = _cached_captions(digests)
+    captions = [cached.get(d) for d in digests]
+
+    missing = [i for i, caption in enumerate(captions) if caption is None]
+    if missing:
+        fresh = {}
+        for i, caption in zip(missing, _model_captions([paths[i] for i in missing])):
+            if caption is None:
+                caption = _fallback_caption(paths[i])
+            else:
+                fresh[digests[i]] = caption
+            captions[i] = caption
+        if fresh:
+            _store_captions(fresh)
+    if len(missing) < len(paths):
+        logger.debug("Caption cache hits: {}/{}", len(paths) - len(missing), len(paths))
+    return captions
+
+
+def prepare_image(stored_path, original_name, thumbnail_dir):
+    """
+    CPU stages for one stored upload: metadata, EXIF and thumbnails. Captioning is done
+    separately by caption_prepared so the GPU stage can batch across images; it also stamps processed_at.
+    """
+    prefix = secrets.token_hex(8)
+    # Caption cache key; hashed here so the caption thread doesn't re-read the file
+    digest_future = _HASH_EXECUTOR.submit(file_sha256, stored_path)
     pil_img = safe_open_image(stored_path)
+    st = os.stat(stored_path)
 
     metadata = {
         "width": pil_img.width,
         "height": pil_img.height,
         "format": pil_img.format.lower() if pil_img.format else None,
-        "size_bytes": os.path.getsize(stored_path),
-        "file_datetime": datetime.fromtimestamp(os.path.getmtime(stored_path), timezone.utc).isoformat(),
-        "processed_at": datetime.now(timezone.utc).isoformat()
+        "size_bytes": st.st_size,
+        "file_datetime": datetime.fromtimestamp(st.st_mtime, timezone.utc).isoformat()
     }
 
-    exif = extract_exif(stored_path)
+    # EXIF comes from the header bytes Pillow already read, so read it before thumbnailing touches the image
+    exif = extract_exif(pil_img, stored_path)
     if exif:
         metadata["exif"] = exif
 
-    thumbnails = generate_thumbnails(pil_img, original_name, timestamp, thumbnail_dir)
-    caption = generate_local_caption_from_path(stored_path)
+    thumbnails = generate_thumbnails(pil_img, original_name, prefix, thumbnail_dir)
 
     return {
         "stored_path": stored_path,
-        "processed_at": datetime.now(timezone.utc),
+        "sha256": digest_future.result(),
         "metadata": metadata,
-        "thumbnails": thumbnails,
-        "caption": caption
+        "thumbnails": thumbnails
     }
+
+
+def caption_prepared(results):
+    """
+    Add "caption" and "processed_at" to prepared results, captioning them in one batch.
+    """
+    captions = generate_captions([r["stored_path"] for r in results], [r["sha256"] for r in results])
+    # One timestamp for both the row's processed_at and the metadata copy
+    processed_at = datetime.now(timezone.utc)
+    for result, caption in zip(results, captions):
+        result["caption"] = caption
+        result["processed_at"] = processed_at
+        result["metadata"]["processed_at"] = processed_at.isoformat()
+        # Every stage that reads the original is done; only the thumbnails are served from here on
+        _drop_page_cache(result["stored_path"])
+    return results
+
+
+def _drop_page_cache(path):
+    # Hint the kernel to evict the file's pages so burst uploads don't push hotter data out of the
+    # page cache. Dirty pages are queued for writeback rather than dropped. No-op where unsupported.
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.debug("posix_fadvise failed for {}: {}", path, e)
@@ -1,55 +1,142 @@
-import threading, queue, time
-from .imageProcessing import process_image_task
+import atexit, functools, multiprocessing, os, threading, queue, time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from sqlalchemy import update
+from .imageProcessing import HF_API_KEY, prepare_image, caption_prepared, load_caption_model
 from ..models.database import SessionLocal
 from ..models.imageModel import Image
 from ..utils.logging import logger
 
-_JOB_QUEUE = queue.Queue()
+# Upload jobs -> process pool of prepare workers (metadata/EXIF/thumbnails) -> caption queue ->
+# single caption thread (batched BLIP + DB writes). The request thread only submits.
+_CAPTION_QUEUE = queue.Queue()
+_PREPARE_POOL = None
+_POOL_LOCK = threading.Lock()
+_THUMBNAIL_DIR = None
 _WORKER_STARTED = False
 
+# Processes per app process. Each gunicorn worker (WEB_CONCURRENCY, which gunicorn also reads for -w)
+# gets its own pool, so the default splits the spare CPUs between them instead of oversubscribing
+WEB_CONCURRENCY = max(1, int(os.getenv("WEB_CONCURRENCY") or 1))
+PREPARE_WORKERS = int(os.getenv("PREPARE_WORKERS", max(1, ((os.cpu_count() or 2) - 1) // WEB_CONCURRENCY)))
+
+# Micro-batching: wait at most BATCH_WAIT seconds for up to MAX_BATCH jobs
+MAX_BATCH = 8
+BATCH_WAIT = 0.05
+
+def _gather_batch(source):
+    """Block for the first item, then drain whatever else arrives within BATCH_WAIT."""
+    batch = [source.get()]
+    deadline = time.monotonic() + BATCH_WAIT
+    while batch[-1] is not None and len(batch) < MAX_BATCH:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(source.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+def _save_result(image_id, result):
+    # Single UPDATE ... WHERE id = ?, no SELECT of the row first
+    with SessionLocal() as db:
+        updated = db.execute(update(Image).where(Image.id == image_id).values(
+            thumbnails=result["thumbnails"],
+            image_metadata=result["metadata"],
+            caption=result["caption"],
+            processed_at=result["processed_at"],
+            status="success"
+        )).rowcount
+        db.commit()
+        if updated:
+            logger.info("Job success {}", image_id)
+
+def _mark_failed(image_id):
+    with SessionLocal() as db:
+        db.execute(update(Image).where(Image.id == image_id).values(status="failed"))
+        db.commit()
+
+def _on_prepared(image_id, future):
+    # Runs on the pool's result thread: hand successful jobs to the caption thread
+    try:
+        _CAPTION_QUEUE.put((image_id, future.result()))
+    except Exception as e:
+        logger.exception("Job failed {}: {}", image_id, e)
+        try:
+            _mark_failed(image_id)
+        except Exception as e:
+            logger.exception("Could not mark job {} failed: {}", image_id, e)
+
+def _new_prepare_pool():
+    # Pillow work runs in separate processes so it isn't serialised on the GIL. "spawn" avoids
+    # forking a process that already has threads (logging, caption thread) holding locks.
+    return ProcessPoolExecutor(max_workers=PREPARE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+def _shutdown_prepare_pool():
+    _PREPARE_POOL.shutdown()
+
+def _submit_prepare(*args):
+    global _PREPARE_POOL
+    pool = _PREPARE_POOL
+    try:
+        return pool.submit(prepare_image, *args)
+    except BrokenProcessPool:
+        # A child died abruptly (e.g. OOM-killed on a huge image); the executor never recovers on its own
+        with _POOL_LOCK:
+            if _PREPARE_POOL is pool:
+                logger.warning("Prepare process pool broken; starting a new one")
+                _PREPARE_POOL = _new_prepare_pool()
+                pool.shutdown(wait=False)
+        return _PREPARE_POOL.submit(prepare_image, *args)
+
 def start_worker(app):
-    global _WORKER_STARTED
+    global _WORKER_STARTED, _PREPARE_POOL, _THUMBNAIL_DIR
     if _WORKER_STARTED: return
+    # Spawned pool processes re-import the main module (e.g. main.py's create_app); they only run prepare_image
+    if multiprocessing.parent_process() is not None: return
     _WORKER_STARTED = True
+    _THUMBNAIL_DIR = app.config["THUMBNAIL_DIR"]
+
+    _PREPARE_POOL = _new_prepare_pool()
+    atexit.register(_shutdown_prepare_pool)
 
-    def loop():
-        logger.info("Worker started")
+    def caption_loop():
+        if not HF_API_KEY:
+            # Local BLIP is the primary captioner: load it now rather than on the first job
+            load_caption_model()
         while True:
+            batch = []
             try:
-                job = _JOB_QUEUE.get()
-                if job is None: break
-                image_id, stored_path, original_name = job.values()
-                thumb_dir = app.config["THUMBNAIL_DIR"]
-                upload_dir = app.config["UPLOAD_DIR"]
-                logger.info(f"Processing image {image_id}")
-                try:
-                    result = process_image_task(stored_path, original_name, upload_dir, thumb_dir)
-                    with SessionLocal() as db:
-                        img = db.query(Image).filter(Image.id == image_id).first()
-                        if img:
-                            img.thumbnails = result["thumbnails"]
-                            img.image_metadata = result["metadata"]
-                            img.caption = result["caption"]
-                            img.processed_at = result["processed_at"]
-                            img.status = "success"
-                            db.add(img)
-                            db.commit()
-                            logger.info(f"Job success {image_id}")
-                except Exception as e:
-                    logger.exception(f"Job failed {image_id}: {e}")
-                    with SessionLocal() as db:
-                        img = db.query(Image).filter(Image.id==image_id).first()
-                        if img:
-                            img.status = "failed"
-                            db.add(img)
-                            db.commit()
-                finally:
-                    _JOB_QUEUE.task_done()
+                batch = _gather_batch(_CAPTION_QUEUE)
+                stop = batch[-1] is None
+                items = [item for item in batch if item is not None]
+                if items:
+                    try:
+                        caption_prepared([result for _, result in items])
+                    except Exception as e:
+                        logger.exception("Caption batch failed: {}", e)
+                        for image_id, _ in items:
+                            _mark_failed(image_id)
+                    else:
+                        for image_id, result in items:
+                            try:
+                                _save_result(image_id, result)
+                            except Exception as e:
+                                logger.exception("Job failed {}: {}", image_id, e)
+                                _mark_failed(image_id)
+                if stop: break
             except Exception as e:
-                logger.exception(f"Worker loop error: {e}")
+                logger.exception("Caption loop error: {}", e)
                 time.sleep(1)
+            finally:
+                for _ in batch:
+                    _CAPTION_QUEUE.task_done()
 
-    threading.Thread(target=loop, daemon=True, name="Worker").start()
+    threading.Thread(target=caption_loop, daemon=True, name="CaptionWorker").start()
+    logger.info("Worker started ({} prepare processes, 1 caption thread)", PREPARE_WORKERS)
 
 def enqueue_image_job(image_id, stored_path, original_name):
-    _JOB_QUEUE.put({"image_id": image_id, "stored_path": stored_path, "original_name": original_name})
+    logger.debug("Processing image {}", image_id)
+    future = _submit_prepare(stored_path, original_name, _THUMBNAIL_DIR)
+    future.add_done_callback(functools.partial(_on_prepared, image_id))
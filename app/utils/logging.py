@@ -6,12 +6,20 @@ import os
 LOG_DIR = os.path.join(os.path.dirname(__file__), "..", "logs")
 os.makedirs(LOG_DIR, exist_ok=True)
 
+# Set LOG_LEVEL=WARNING in production to drop the per-image INFO records
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
+# enqueue=True hands records to a background writer so callers never block on sink I/O;
+# backtrace/diagnose off skips capturing extended tracebacks and local variable values
 logger.remove()
-logger.add(sys.stdout, level="INFO")
+logger.add(sys.stdout, level=LOG_LEVEL, enqueue=True, backtrace=False, diagnose=False)
 logger.add(
     os.path.join(LOG_DIR, "app.log"),
     rotation="1 MB",
     retention="7 days",
-    level="INFO",
-    format="{time:YYYY-MM-DD HH:mm:ss} | {level} | {module}:{function}:{line} | {message}"
+    level=LOG_LEVEL,
+    format="{time:YYYY-MM-DD HH:mm:ss} | {level} | {module}:{function}:{line} | {message}",
+    enqueue=True,
+    backtrace=False,
+    diagnose=False
 )
@@ -0,0 +1,49 @@
+import os
+import tempfile
+from flask import Request, current_app
+
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+
+class UploadRequest(Request):
+    """
+    Spools multipart file parts straight into UPLOAD_DIR instead of memory//tmp,
+    so the route can hard-link the part into place without copying it.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.NamedTemporaryFile("wb+", dir=current_app.config["UPLOAD_DIR"], prefix=".upload_")
+
+
+def save_upload(file_storage, stored_path):
+    stream = file_storage.stream
+    spooled_path = getattr(stream, "name", None)
+    if isinstance(spooled_path, str) and os.path.dirname(spooled_path) == os.path.dirname(stored_path):
+        stream.flush()
+        try:
+            os.link(spooled_path, stored_path)
+            return
+        except OSError:
+            # No hard links here (EXDEV, EPERM, ...); copy instead. Renaming isn't an option since the
+            # spooled NamedTemporaryFile unlinks its own path when the request closes it.
+            stream.seek(0)
+    file_storage.save(stored_path, buffer_size=UPLOAD_CHUNK_SIZE)
+
+
+def stream_to_file(stream, stored_path):
+    """Copy a raw request body to stored_path; returns the number of bytes written."""
+    size = 0
+    try:
+        # Buffered writer: f.write() loops until the whole chunk is written (os.write may write less)
+        with open(stored_path, "wb") as f:
+            while chunk := stream.read(UPLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        # Client disconnects and oversized bodies must not leave a partial upload behind
+        try:
+            os.unlink(stored_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return size
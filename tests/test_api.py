@@ -52,6 +52,38 @@ def test_upload_image():
         print(f"❌ Upload error: {e}")
         return None
 
+def test_raw_upload_image():
+    """Test raw body upload (application/octet-stream, filename in the query string)"""
+    print("\n--- Testing Raw Image Upload ---")
+
+    test_image_path = "app/statics/test_image.jpg"
+    if not os.path.exists(test_image_path):
+        print("No test image found. Please create a test image or provide a path.")
+        return None
+
+    try:
+        with open(test_image_path, 'rb') as f:
+            response = requests.post(
+                f"{BASE_URL}/api/images",
+                params={'filename': 'raw_test_image.jpg'},
+                data=f,
+                headers={'Content-Type': 'application/octet-stream'}
+            )
+
+        print(f"Raw upload response: {response.status_code}")
+        if response.status_code == 202:
+            data = response.json()
+            image_id = data['data']['image_id']
+            print(f"✅ Raw upload successful! Image ID: {image_id}")
+            return image_id
+        else:
+            print(f"❌ Raw upload failed: {response.text}")
+            return None
+
+    except Exception as e:
+        print(f"❌ Raw upload error: {e}")
+        return None
+
 def test_list_images():
     """Test listing images"""
     print("\n--- Testing List Images ---")
@@ -70,6 +102,49 @@ def test_list_images():
         print(f"❌ List error: {e}")
         return []
 
+def test_pagination(limit=2):
+    """Test keyset pagination: newest first, at most `limit` per page, no next_cursor on the last page"""
+    print(f"\n--- Testing Pagination (limit={limit}) ---")
+    try:
+        seen = []
+        cursor = None
+        while True:
+            params = {'limit': limit}
+            if cursor is not None:
+                params['cursor'] = cursor
+            response = requests.get(f"{BASE_URL}/api/images", params=params)
+            if response.status_code != 200:
+                print(f"❌ Page request failed: {response.text}")
+                return False
+            data = response.json()
+            ids = [image['image_id'] for image in data['data']]
+            if len(ids) > limit:
+                print(f"❌ Page has {len(ids)} images, more than limit {limit}")
+                return False
+            if cursor is not None and any(image_id >= cursor for image_id in ids):
+                print(f"❌ Page after cursor {cursor} contains ids {ids}")
+                return False
+            seen.extend(ids)
+            next_cursor = data['next_cursor']
+            if next_cursor is None:
+                break
+            if len(ids) != limit or next_cursor != ids[-1]:
+                print(f"❌ next_cursor {next_cursor} should be the last id of a full page, got ids {ids}")
+                return False
+            cursor = next_cursor
+
+        if seen != sorted(seen, reverse=True) or len(seen) != len(set(seen)):
+            print(f"❌ Pages are not in newest-first order without duplicates: {seen}")
+            return False
+        if len(ids) == limit:
+            print(f"❌ Last page is full ({ids}) but next_cursor is null")
+            return False
+        print(f"✅ Paged through {len(seen)} images, last page has no next_cursor")
+        return True
+    except Exception as e:
+        print(f"❌ Pagination error: {e}")
+        return False
+
 def test_image_details(image_id):
     """Test getting image details"""
     print(f"\n--- Testing Image Details (ID: {image_id}) ---")
@@ -138,6 +213,7 @@ def main():
     if not image_id:
         print("⚠️  Skipping remaining tests due to upload failure")
         return
+    raw_image_id = test_raw_upload_image()
     
     # Wait a bit for processing
     print("\n⏳ Waiting 3 seconds for processing...")
@@ -145,7 +221,10 @@ def main():
     
     # Test other endpoints
     test_list_images()
+    test_pagination()
     test_image_details(image_id)
+    if raw_image_id:
+        test_image_details(raw_image_id)
     test_thumbnail(image_id, "small")
     test_thumbnail(image_id, "medium") 
     test_stats()